@@ -270,6 +270,15 @@ _C.MODEL.ROI_HEADS.NMS_THRESH_TEST = 0.5
 # If True, augment proposals with ground-truth boxes before sampling proposals to
 # train ROI heads.
 _C.MODEL.ROI_HEADS.PROPOSAL_APPEND_GT = True
+# Data type used by CUDA autocast for the compute-heavy parts of the ROI heads
+# (pooling, res5 / box head, box predictor, mask and keypoint heads).
+# One of "float32" (autocast disabled), "float16" or "bfloat16".
+_C.MODEL.ROI_HEADS.AMP_DTYPE = "float32"
+# If True, the mask and keypoint heads, including the triple-branch mask heads
+# (weights and pooled features), use the channels_last memory format, which
+# cuDNN runs faster on tensor cores, especially together with a float16 or
+# bfloat16 AMP_DTYPE.
+_C.MODEL.ROI_HEADS.CHANNELS_LAST = False
 
 # ---------------------------------------------------------------------------- #
 # Box Head
@@ -301,6 +310,9 @@ _C.MODEL.ROI_BOX_HEAD.NORM = ""
 _C.MODEL.ROI_BOX_HEAD.CLS_AGNOSTIC_BBOX_REG = False
 # If true, RoI heads use bounding boxes predicted by the box head rather than proposal boxes.
 _C.MODEL.ROI_BOX_HEAD.TRAIN_ON_PRED_BOXES = False
+# If true, DefaultPredictor dynamically quantizes the fc layers of the box head to int8
+# after loading the weights. The box predictor stays in float. Requires MODEL.DEVICE "cpu".
+_C.MODEL.ROI_BOX_HEAD.QUANTIZE_FC_INFERENCE = False
 
 # ---------------------------------------------------------------------------- #
 # Cascaded Box Head
@@ -32,6 +32,7 @@ from detectron2.evaluation import (
     verify_results,
 )
 from detectron2.modeling import build_model
+from detectron2.modeling.roi_heads import quantize_box_head_fcs
 from detectron2.solver import build_lr_scheduler, build_optimizer
 from detectron2.utils import comm
 from detectron2.utils.collect_env import collect_env_info
@@ -166,6 +167,22 @@ class DefaultPredictor:
         checkpointer = DetectionCheckpointer(self.model)
         checkpointer.load(cfg.MODEL.WEIGHTS)
 
+        if cfg.MODEL.ROI_BOX_HEAD.QUANTIZE_FC_INFERENCE:
+            if cfg.MODEL.DEVICE != "cpu":
+                raise ValueError(
+                    "MODEL.ROI_BOX_HEAD.QUANTIZE_FC_INFERENCE requires MODEL.DEVICE='cpu', "
+                    "got '{}': quantized fc layers only run on CPU!".format(cfg.MODEL.DEVICE)
+                )
+            roi_heads = getattr(self.model, "roi_heads", None)
+            if hasattr(roi_heads, "box_head"):
+                quantize_box_head_fcs(roi_heads.box_head)
+            else:
+                # E.g. Res5ROIHeads (C4 models) have no separate fc box head
+                logging.getLogger(__name__).warning(
+                    "MODEL.ROI_BOX_HEAD.QUANTIZE_FC_INFERENCE is ignored: "
+                    "the ROI heads of this model have no box_head."
+                )
+
         self.transform_gen = T.ResizeShortestEdge(
             [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
         )
@@ -211,6 +211,17 @@ class ROIPooler(nn.Module):
 
         pooler_fmt_boxes = convert_boxes_to_pooler_format(box_lists)
 
+        num_boxes = len(pooler_fmt_boxes)
+        num_channels = x[0].shape[1]
+        output_size = self.output_size[0]
+
+        dtype, device = x[0].dtype, x[0].device
+        if num_boxes == 0:
+            # E.g. no detection survived NMS: skip the level assignment and per-level pooling
+            return torch.zeros(
+                (0, num_channels, output_size, output_size), dtype=dtype, device=device
+            )
+
         if num_level_assignments == 1:
             return self.level_poolers[0](x[0], pooler_fmt_boxes)
 
@@ -218,11 +229,6 @@ class ROIPooler(nn.Module):
             box_lists, self.min_level, self.max_level, self.canonical_box_size, self.canonical_level
         )
 
-        num_boxes = len(pooler_fmt_boxes)
-        num_channels = x[0].shape[1]
-        output_size = self.output_size[0]
-
-        dtype, device = x[0].dtype, x[0].device
         output = torch.zeros(
             (num_boxes, num_channels, output_size, output_size), dtype=dtype, device=device
         )
@@ -1,5 +1,5 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
-from .box_head import ROI_BOX_HEAD_REGISTRY, build_box_head
+from .box_head import ROI_BOX_HEAD_REGISTRY, build_box_head, quantize_box_head_fcs
 from .keypoint_head import ROI_KEYPOINT_HEAD_REGISTRY, build_keypoint_head
 from .mask_head import ROI_MASK_HEAD_REGISTRY, build_mask_head, BaseMaskRCNNHead
 from .roi_heads import (
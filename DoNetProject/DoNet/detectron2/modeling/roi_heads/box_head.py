@@ -77,7 +77,7 @@ class FastRCNNConvFCHead(nn.Module):
             if x.dim() > 2:
                 x = torch.flatten(x, start_dim=1)
             for layer in self.fcs:
-                x = F.relu(layer(x))
+                x = F.relu(layer(x), inplace=True)
         return x
 
     @property
@@ -91,3 +91,19 @@ def build_box_head(cfg, input_shape):
     """
     name = cfg.MODEL.ROI_BOX_HEAD.NAME
     return ROI_BOX_HEAD_REGISTRY.get(name)(cfg, input_shape)
+
+
+def quantize_box_head_fcs(box_head):
+    """
+    Dynamically quantize the fc layers of a trained box head to int8, in place, for
+    inference. Dynamically quantized fc layers only run on CPU.
+
+    Args:
+        box_head (nn.Module): a box head (or a module containing box heads, e.g. the
+            per-stage heads of cascade R-CNN) with its weights already loaded.
+    """
+    torch.quantization.quantize_dynamic(box_head, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    for head in box_head.modules():
+        if isinstance(head, FastRCNNConvFCHead):
+            # `fcs` still refers to the float modules that were swapped out
+            head.fcs = [getattr(head, "fc{}".format(k + 1)) for k in range(len(head.fcs))]
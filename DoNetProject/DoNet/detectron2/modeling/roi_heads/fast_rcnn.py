@@ -1,6 +1,7 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 import logging
 import numpy as np
+from typing import Optional
 import torch
 from fvcore.nn import smooth_l1_loss
 from torch import nn
@@ -158,12 +159,14 @@ def fast_rcnn_inference_single_image(
     # R' x 2. First column contains indices of the R predictions;
     # Second column contains indices of classes.
     filter_inds = filter_mask.nonzero()
+    # Index with `filter_inds` rather than `filter_mask`: boolean indexing would run
+    # another nonzero (and host sync) for each of the boxes and the scores.
     if num_bbox_reg_classes == 1:
         boxes = boxes[filter_inds[:, 0], 0]
     else:
-        boxes = boxes[filter_mask]
+        boxes = boxes[filter_inds[:, 0], filter_inds[:, 1]]
 
-    scores = scores[filter_mask]
+    scores = scores[filter_inds[:, 0], filter_inds[:, 1]]
 
     # Apply per-class NMS
     keep = batched_nms(boxes, scores, filter_inds[:, 1], nms_thresh)
@@ -204,12 +207,13 @@ def fast_rcnn_inference_single_image_recon_recls(
     # R' x 2. First column contains indices of the R predictions;
     # Second column contains indices of classes.
     filter_inds = filter_mask.nonzero()
+    # Index with `filter_inds` rather than `filter_mask`, see `fast_rcnn_inference_single_image`
     if num_bbox_reg_classes == 1:
         boxes = boxes[filter_inds[:, 0], 0]
     else:
-        boxes = boxes[filter_mask]
+        boxes = boxes[filter_inds[:, 0], filter_inds[:, 1]]
 
-    scores = scores[filter_mask]
+    scores = scores[filter_inds[:, 0], filter_inds[:, 1]]
 
     # apply recon net
     mask_features = mask_pooler(features, [Boxes(boxes)])
@@ -550,9 +554,34 @@ class FastRCNNOutputLayers(nn.Module):
         return scores, proposal_deltas
 
 
+@torch.jit.script
+def _select_mask_logits(
+        pred_mask_logits: torch.Tensor, classes: Optional[torch.Tensor]
+) -> torch.Tensor:
+    """
+    Returns:
+        Tensor: (N, 1, M, M) logits of class `classes[i]` for each mask i, or the single
+            channel of class-agnostic mask logits (`classes` is then ignored).
+    """
+    if pred_mask_logits.size(1) == 1:
+        # (N, 1, M, M) view, no copy
+        return pred_mask_logits.narrow(1, 0, 1)
+    assert classes is not None
+    mask_side_len = pred_mask_logits.size(2)
+    class_inds = classes.to(device=pred_mask_logits.device, dtype=torch.int64)
+    # Gather along the class dim: no arange index tensor, and a cheaper backward
+    # than advanced indexing. The result is already (N, 1, M, M).
+    # The index is a stride-0 expanded view, which gather reads as is: do not make it
+    # contiguous, that would materialize an N*M*M int64 tensor.
+    return torch.gather(
+        pred_mask_logits,
+        1,
+        class_inds.reshape(-1, 1, 1, 1).expand(-1, 1, mask_side_len, mask_side_len),
+    )
+
+
 def get_pred_masks_logits_by_cls(pred_mask_logits, instances):
     cls_agnostic_mask = pred_mask_logits.size(1) == 1
-    total_num_masks = pred_mask_logits.size(0)
 
     if isinstance(instances, list):
         mask_side_len = pred_mask_logits.size(2)
@@ -564,8 +593,7 @@ def get_pred_masks_logits_by_cls(pred_mask_logits, instances):
             if len(instances_per_image) == 0:
                 continue
             if not cls_agnostic_mask:
-                gt_classes_per_image = instances_per_image.gt_classes.to(dtype=torch.int64)
-                gt_classes.append(gt_classes_per_image)
+                gt_classes.append(instances_per_image.gt_classes)
             gt_masks_per_image = instances_per_image.gt_masks.crop_and_resize(
                 instances_per_image.proposal_boxes.tensor, mask_side_len
             ).to(device=pred_mask_logits.device)
@@ -576,20 +604,11 @@ def get_pred_masks_logits_by_cls(pred_mask_logits, instances):
             return pred_mask_logits.sum() * 0
         gt_masks = cat(gt_masks, dim=0)
 
-        if cls_agnostic_mask:
-            pred_mask_logits = pred_mask_logits[:, 0]
-        else:
-            indices = torch.arange(total_num_masks)
-            gt_classes = cat(gt_classes, dim=0)
-            pred_mask_logits = pred_mask_logits[indices, gt_classes]
+        pred_mask_logits = _select_mask_logits(
+            pred_mask_logits, None if cls_agnostic_mask else cat(gt_classes, dim=0))
 
         gt_masks = gt_masks.float()
 
-        return pred_mask_logits.unsqueeze(1), gt_masks.unsqueeze(1)
+        return pred_mask_logits, gt_masks.unsqueeze(1)
     else:
-        indices = torch.arange(total_num_masks)
-        gt_classes = instances
-
-        pred_mask_logits = pred_mask_logits[indices, gt_classes]
-
-        return pred_mask_logits.unsqueeze(1)
+        return _select_mask_logits(pred_mask_logits, instances)
@@ -71,7 +71,8 @@ def keypoint_rcnn_loss(pred_keypoint_logits, instances, normalizer):
         return pred_keypoint_logits.sum() * 0
 
     N, K, H, W = pred_keypoint_logits.shape
-    pred_keypoint_logits = pred_keypoint_logits.view(N * K, H * W)
+    # reshape rather than view: the logits may be in channels_last memory format
+    pred_keypoint_logits = pred_keypoint_logits.reshape(N * K, H * W)
 
     keypoint_loss = F.cross_entropy(
         pred_keypoint_logits[valid], keypoint_targets[valid], reduction="sum"
@@ -136,6 +136,8 @@ def triple_branch_overlapping_mask_rcnn_inference(pred_mask_logits, pred_instanc
             the predicted masks to the original image resolution and/or binarizing them, is left
             to the caller.
     """
+    # The mask head may run under autocast; the probabilities are returned in float32
+    pred_mask_logits = pred_mask_logits.float()
     cls_agnostic_mask = pred_mask_logits.size(1) == 1
 
     if cls_agnostic_mask:
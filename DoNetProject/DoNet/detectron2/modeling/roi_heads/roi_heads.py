@@ -1,4 +1,5 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+import contextlib
 import logging
 import numpy as np
 from typing import Dict, List, Optional, Tuple, Union
@@ -7,7 +8,7 @@ from torch import nn
 from torch.nn import functional as F
 
 from detectron2.layers import ShapeSpec
-from detectron2.structures import Boxes, ImageList, Instances, pairwise_iou
+from detectron2.structures import BitMasks, Boxes, ImageList, Instances, PolygonMasks, pairwise_iou
 from detectron2.utils.events import get_event_storage
 from detectron2.utils.registry import Registry
 
@@ -18,7 +19,11 @@ from ..poolers import ROIPooler
 from ..proposal_generator.proposal_utils import add_ground_truth_to_proposals
 from ..sampling import subsample_labels
 from .box_head import build_box_head
-from .fast_rcnn import FastRCNNOutputLayers, FastRCNNOutputs
+from .fast_rcnn import (  # noqa: F401 (get_pred_masks_logits_by_cls is kept importable here)
+    FastRCNNOutputLayers,
+    FastRCNNOutputs,
+    get_pred_masks_logits_by_cls,
+)
 from .keypoint_head import build_keypoint_head, keypoint_rcnn_inference, keypoint_rcnn_loss
 from .mask_head import build_mask_head
 
@@ -41,7 +46,6 @@ from .mask_triple_branch_whole_head import build_triple_branch_whole_mask_head
 from .recls_head import build_recls_head, mask_recls_filter_loss, mask_recls_margin_loss, mask_recls_adaptive_loss
 from detectron2.layers import cat, Conv2d
 import os
-import matplotlib.pyplot as plt
 
 ROI_HEADS_REGISTRY = Registry("ROI_HEADS")
 ROI_HEADS_REGISTRY.__doc__ = """
@@ -55,6 +59,18 @@ The call is expected to return an :class:`ROIHeads`.
 
 logger = logging.getLogger(__name__)
 
+# Upper bound on the size of the (sum(#gt) x sum(#proposals)) IoU matrix computed
+# by a single batched `pairwise_iou` call. The batched call also computes all the
+# cross-image pairs, so it only pays off for small batches, where the per-image
+# calls are dominated by kernel launches; larger batches use per-image IoU.
+_BATCHED_IOU_MAX_ELEMENTS = 64 * 1024
+# Match quality matrices with fewer entries than this are matched on CPU: at such sizes
+# the matcher is dominated by CUDA kernel launches rather than by compute.
+_CPU_MATCHING_MAX_ELEMENTS = 4096
+
+# Constant-filled buffers reused across iterations, see `_const_full`.
+_CONST_CACHE: Dict[Tuple[torch.device, torch.dtype, int], torch.Tensor] = {}
+
 
 def build_roi_heads(cfg, input_shape):
     """
@@ -64,6 +80,12 @@ def build_roi_heads(cfg, input_shape):
     return ROI_HEADS_REGISTRY.get(name)(cfg, input_shape)
 
 
+@torch.jit.script
+def _foreground_mask(gt_classes: torch.Tensor, bg_label: int) -> torch.Tensor:
+    # -1 (ignore) is the only negative label, so `>= 0` is the same as `!= -1`.
+    return (gt_classes >= 0) & (gt_classes != bg_label)
+
+
 def select_foreground_proposals(
         proposals: List[Instances], bg_label: int
 ) -> Tuple[List[Instances], List[torch.Tensor]]:
@@ -85,14 +107,17 @@ def select_foreground_proposals(
     assert isinstance(proposals, (list, tuple))
     assert isinstance(proposals[0], Instances)
     assert proposals[0].has("gt_classes")
+    # Compute the selection masks of all images at once, then split them per image.
+    gt_classes = cat([x.gt_classes for x in proposals], dim=0)
+    fg_selection_masks = list(
+        _foreground_mask(gt_classes, bg_label).split([len(x) for x in proposals])
+    )
     fg_proposals = []
-    fg_selection_masks = []
-    for proposals_per_image in proposals:
-        gt_classes = proposals_per_image.gt_classes
-        fg_selection_mask = (gt_classes != -1) & (gt_classes != bg_label)
+    for proposals_per_image, fg_selection_mask in zip(proposals, fg_selection_masks):
+        # One nonzero per image: indexing Instances with the boolean mask would run
+        # one nonzero (and device sync) per field.
         fg_idxs = fg_selection_mask.nonzero().squeeze(1)
         fg_proposals.append(proposals_per_image[fg_idxs])
-        fg_selection_masks.append(fg_selection_mask)
     return fg_proposals, fg_selection_masks
 
 
@@ -115,33 +140,200 @@ def select_proposals_with_visible_keypoints(proposals: List[Instances]) -> List[
     """
     ret = []
     all_num_fg = []
+    # Empty/unannotated images (hard negatives) may not carry "gt_keypoints",
+    # so only the non-empty images take part in the batched selection below.
+    nonempty_proposals = [x for x in proposals if len(x) > 0]
+    if len(nonempty_proposals) > 0:
+        # sum(#fg) x K x 3
+        gt_keypoints = torch.cat([x.gt_keypoints.tensor for x in nonempty_proposals], dim=0)
+        vis_mask = gt_keypoints[:, :, 2] >= 1
+        xs, ys = gt_keypoints[:, :, 0], gt_keypoints[:, :, 1]
+        proposal_boxes = torch.cat(
+            [x.proposal_boxes.tensor for x in nonempty_proposals], dim=0
+        ).unsqueeze(dim=1)  # sum(#fg) x 1 x 4
+        kp_in_box = xs >= proposal_boxes[:, :, 0]
+        kp_in_box &= xs <= proposal_boxes[:, :, 2]
+        kp_in_box &= ys >= proposal_boxes[:, :, 1]
+        kp_in_box &= ys <= proposal_boxes[:, :, 3]
+        kp_in_box &= vis_mask
+        selection = kp_in_box.any(dim=1)
+        selections = iter(torch.split(selection, [len(x) for x in nonempty_proposals]))
+
     for proposals_per_image in proposals:
         # If empty/unannotated image (hard negatives), skip filtering for train
         if len(proposals_per_image) == 0:
             ret.append(proposals_per_image)
             continue
-        gt_keypoints = proposals_per_image.gt_keypoints.tensor
-        # #fg x K x 3
-        vis_mask = gt_keypoints[:, :, 2] >= 1
-        xs, ys = gt_keypoints[:, :, 0], gt_keypoints[:, :, 1]
-        proposal_boxes = proposals_per_image.proposal_boxes.tensor.unsqueeze(
-            dim=1)  # #fg x 1 x 4
-        kp_in_box = (
-                (xs >= proposal_boxes[:, :, 0])
-                & (xs <= proposal_boxes[:, :, 2])
-                & (ys >= proposal_boxes[:, :, 1])
-                & (ys <= proposal_boxes[:, :, 3])
-        )
-        selection = (kp_in_box & vis_mask).any(dim=1)
-        selection_idxs = torch.nonzero(selection).squeeze(1)
+        selection_idxs = torch.nonzero(next(selections)).squeeze(1)
         all_num_fg.append(selection_idxs.numel())
         ret.append(proposals_per_image[selection_idxs])
 
+    # Recorded on every iteration (numel() needs no sync), so that the writers' smoothed
+    # value covers the iterations they report on.
     storage = get_event_storage()
     storage.put_scalar("keypoint_head/num_fg_samples", np.mean(all_num_fg))
     return ret
 
 
+@contextlib.contextmanager
+def _null_context():
+    # contextlib.nullcontext requires python 3.7+
+    yield
+
+
+def _parse_amp_dtype(name: str) -> torch.dtype:
+    """
+    Returns:
+        torch.dtype: the dtype given by `MODEL.ROI_HEADS.AMP_DTYPE`, checked to be
+            supported by the installed PyTorch.
+    """
+    if name not in ("float32", "float16", "bfloat16"):
+        raise ValueError(
+            "MODEL.ROI_HEADS.AMP_DTYPE must be one of 'float32', 'float16' or 'bfloat16', "
+            "got '{}'!".format(name)
+        )
+    dtype = getattr(torch, name)
+    if dtype != torch.float32 and not hasattr(torch, "autocast"):
+        # torch.cuda.amp.autocast (PyTorch 1.6 - 1.9) has no dtype argument
+        if dtype != torch.float16 or not hasattr(torch.cuda, "amp"):
+            raise ValueError(
+                "MODEL.ROI_HEADS.AMP_DTYPE='{}' is not supported by PyTorch {}: "
+                "bfloat16 autocast needs PyTorch >= 1.10 and float16 needs >= 1.6.".format(
+                    name, torch.__version__
+                )
+            )
+    return dtype
+
+
+def _const_full(size: int, value: int, dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+    """
+    Like `torch.full((size,), value)`, but returns a slice of a cached buffer that
+    is only reallocated when a larger size is requested.
+    The returned tensor is shared and must not be modified in place.
+    """
+    key = (device, dtype, value)
+    buf = _CONST_CACHE.get(key)
+    if buf is None or buf.numel() < size:
+        buf = torch.full((size,), value, dtype=dtype, device=device)
+        _CONST_CACHE[key] = buf
+    return buf[:size]
+
+
+def _pairwise_iou_per_image(gt_boxes: List[Boxes], proposal_boxes: List[Boxes]) -> List[torch.Tensor]:
+    """
+    Compute the per-image IoU matrices between `gt_boxes[i]` and `proposal_boxes[i]`.
+
+    For small batches (see `_BATCHED_IOU_MAX_ELEMENTS`), the boxes of all images are
+    concatenated and a single `pairwise_iou` is computed; the diagonal blocks of the
+    result are the per-image matrices. Cross-image pairs are computed but never read.
+    The blocks are taken as views of the batched matrix, so no block-diagonal mask is
+    built. Otherwise the IoU is computed image by image.
+
+    Args:
+        gt_boxes (list[Boxes]): N Boxes, the ground-truth boxes of each image.
+        proposal_boxes (list[Boxes]): N Boxes, the proposal boxes of each image.
+
+    Returns:
+        list[Tensor]: N tensors, the i-th one of shape (#gt_i, #proposals_i).
+    """
+    gt_counts = [len(x) for x in gt_boxes]
+    proposal_counts = [len(x) for x in proposal_boxes]
+    if len(gt_boxes) == 1 or sum(gt_counts) * sum(proposal_counts) > _BATCHED_IOU_MAX_ELEMENTS:
+        return [pairwise_iou(g, p) for g, p in zip(gt_boxes, proposal_boxes)]
+
+    match_quality_matrix = pairwise_iou(Boxes.cat(gt_boxes), Boxes.cat(proposal_boxes))
+    return [
+        rows.split(proposal_counts, dim=1)[i]
+        for i, rows in enumerate(match_quality_matrix.split(gt_counts, dim=0))
+    ]
+
+
+def _gather_sampled_targets(
+        proposals: List[Instances], targets: List[Instances], sampled_targets: List[torch.Tensor]
+) -> None:
+    """
+    Set on each `proposals[i]` all the attributes of `targets[i]` that start with "gt_"
+    and have not been added to the proposals yet (="gt_classes"), indexed by
+    `sampled_targets[i]`.
+
+    Fields stored as tensors (or in a structure backed by `.tensor`, e.g. Boxes) are
+    concatenated across images, gathered once and split back per image. Masks (whose
+    image sizes may differ), other fields and fields that not all images have are
+    indexed image by image.
+
+    Args:
+        proposals (list[Instances]): the sampled proposals of the images that have gt.
+        targets (list[Instances]): the targets of the same images.
+        sampled_targets (list[Tensor]): for each sampled proposal, the index of its
+            matched gt in the corresponding `targets[i]`.
+    """
+    if len(proposals) == 0:
+        return
+    gt_offsets = [0]
+    for targets_per_image in targets[:-1]:
+        gt_offsets.append(gt_offsets[-1] + len(targets_per_image))
+    global_sampled_targets = cat([x + o for x, o in zip(sampled_targets, gt_offsets)], dim=0)
+    split_sizes = [len(x) for x in sampled_targets]
+
+    field_names = [set(x.get_fields().keys()) for x in targets]
+    common_field_names = set.intersection(*field_names)
+    for trg_name, trg_value in targets[0].get_fields().items():
+        if trg_name not in common_field_names or not trg_name.startswith("gt_"):
+            continue
+        if proposals[0].has(trg_name):
+            continue
+        values = [x.get(trg_name) for x in targets]
+        # Concatenated: Tensor and `.tensor`-backed (Boxes, Keypoints); per image: masks, others
+        if isinstance(trg_value, (BitMasks, PolygonMasks)):
+            gathered = [v[i] for v, i in zip(values, sampled_targets)]
+        elif isinstance(trg_value, torch.Tensor):
+            gathered = cat(values, dim=0)[global_sampled_targets].split(split_sizes)
+        elif isinstance(getattr(trg_value, "tensor", None), torch.Tensor):
+            gathered = cat([v.tensor for v in values], dim=0)[global_sampled_targets]
+            gathered = [type(trg_value)(x) for x in gathered.split(split_sizes)]
+        else:
+            gathered = [v[i] for v, i in zip(values, sampled_targets)]
+        for proposals_per_image, value in zip(proposals, gathered):
+            proposals_per_image.set(trg_name, value)
+
+    # Fields that only some of the images have are indexed image by image
+    for proposals_per_image, targets_per_image, sampled_targets_per_image, names in zip(
+        proposals, targets, sampled_targets, field_names
+    ):
+        for trg_name in sorted(names - common_field_names):
+            if trg_name.startswith("gt_") and not proposals_per_image.has(trg_name):
+                proposals_per_image.set(
+                    trg_name, targets_per_image.get(trg_name)[sampled_targets_per_image]
+                )
+
+
+@torch.jit.script
+def _assign_labels(
+        matched_idxs: torch.Tensor,
+        matched_labels: torch.Tensor,
+        gt_classes: torch.Tensor,
+        num_classes: int,
+        filter_out_class: int,
+) -> torch.Tensor:
+    """
+    Scripted label assignment of :meth:`ROIHeads._sample_proposals`, so that the
+    elementwise ops below can be fused instead of launching one kernel each.
+    """
+    gt_classes = gt_classes[matched_idxs]
+    # Label unmatched proposals (0 label from matcher) as background (label=num_classes)
+    # and ignore proposals (-1 label) as -1, in a single expression over `matched_labels`.
+    gt_classes = torch.where(
+        matched_labels == 0,
+        torch.full_like(gt_classes, num_classes),
+        torch.where(matched_labels == -1, torch.full_like(gt_classes, -1), gt_classes),
+    )
+    if filter_out_class != -1:  # if filter class enabled
+        gt_classes = torch.where(
+            gt_classes == filter_out_class, torch.full_like(gt_classes, 2), gt_classes
+        )
+    return gt_classes
+
+
 class ROIHeads(torch.nn.Module):
     """
     ROIHeads perform all per-region computation in an R-CNN.
@@ -166,8 +358,12 @@ class ROIHeads(torch.nn.Module):
         self.proposal_append_gt = cfg.MODEL.ROI_HEADS.PROPOSAL_APPEND_GT
         self.feature_strides = {k: v.stride for k, v in input_shape.items()}
         self.feature_channels = {k: v.channels for k, v in input_shape.items()}
+        self.pooler_scales = tuple(1.0 / self.feature_strides[k] for k in self.in_features)
+        self._poolers = {}
         self.cls_agnostic_bbox_reg = cfg.MODEL.ROI_BOX_HEAD.CLS_AGNOSTIC_BBOX_REG
         self.smooth_l1_beta = cfg.MODEL.ROI_BOX_HEAD.SMOOTH_L1_BETA
+        self.amp_dtype = _parse_amp_dtype(cfg.MODEL.ROI_HEADS.AMP_DTYPE)
+        self.channels_last = cfg.MODEL.ROI_HEADS.CHANNELS_LAST
         # fmt: on
 
         # Matcher to assign box proposals to gt boxes
@@ -181,6 +377,44 @@ class ROIHeads(torch.nn.Module):
         self.box2box_transform = Box2BoxTransform(
             weights=cfg.MODEL.ROI_BOX_HEAD.BBOX_REG_WEIGHTS)
 
+    def _autocast(self):
+        """
+        Returns:
+            A context manager that runs the enclosed ops under CUDA autocast with
+            `self.amp_dtype`, or does nothing if the heads run in float32.
+        """
+        if self.amp_dtype == torch.float32:
+            return _null_context()
+        if hasattr(torch, "autocast"):
+            return torch.autocast("cuda", dtype=self.amp_dtype)
+        # PyTorch < 1.10 only autocasts to float16, see `_parse_amp_dtype`
+        return torch.cuda.amp.autocast()
+
+    def _to_head_memory_format(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Returns:
+            Tensor: the pooled features `x` in the memory format of the mask and keypoint heads.
+        """
+        if self.channels_last:
+            return x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def _build_pooler(self, output_size, sampling_ratio, pooler_type):
+        """
+        Returns:
+            ROIPooler: a pooler over `self.in_features`. Heads that pool identically get
+                the same (parameter-free) instance.
+        """
+        key = (output_size, sampling_ratio, pooler_type)
+        if key not in self._poolers:
+            self._poolers[key] = ROIPooler(
+                output_size=output_size,
+                scales=self.pooler_scales,
+                sampling_ratio=sampling_ratio,
+                pooler_type=pooler_type,
+            )
+        return self._poolers[key]
+
     def _sample_proposals(
             self, matched_idxs: torch.Tensor, matched_labels: torch.Tensor, gt_classes: torch.Tensor,
             filter_out_class=-1
@@ -189,6 +423,22 @@ class ROIHeads(torch.nn.Module):
         Based on the matching between N proposals and M groundtruth,
         sample the proposals and set their classification labels.
 
+        See :meth:`_sample_proposals_with_counts` for the arguments and return values.
+        """
+        sampled_idxs, gt_classes, _, _ = self._sample_proposals_with_counts(
+            matched_idxs, matched_labels, gt_classes, filter_out_class=filter_out_class
+        )
+        return sampled_idxs, gt_classes
+
+    def _sample_proposals_with_counts(
+            self, matched_idxs: torch.Tensor, matched_labels: torch.Tensor, gt_classes: torch.Tensor,
+            filter_out_class=-1
+    ) -> Tuple[torch.Tensor, torch.Tensor, int, int]:
+        """
+        Same as :meth:`_sample_proposals`, but also returns the number of sampled
+        foreground and background proposals, which are known from the sampling
+        without another pass over the labels.
+
         Args:
             matched_idxs (Tensor): a vector of length N, each is the best-matched
                 gt index in [0, M) for each proposal.
@@ -202,26 +452,31 @@ class ROIHeads(torch.nn.Module):
             Tensor: a vector of the same length, the classification label for
                 each sampled proposal. Each sample is labeled as either a category in
                 [0, num_classes) or the background (num_classes).
+            int: the number of sampled foreground proposals.
+            int: the number of sampled background proposals.
         """
         has_gt = gt_classes.numel() > 0
         # Get the corresponding GT for each proposal
         if has_gt:
-            gt_classes = gt_classes[matched_idxs]
-            # Label unmatched proposals (0 label from matcher) as background (label=num_classes)
-            gt_classes[matched_labels == 0] = self.num_classes
-            # Label ignore proposals (-1 label)
-            gt_classes[matched_labels == -1] = -1
-            if filter_out_class != -1:  # if filter class enabled
-                gt_classes[gt_classes == filter_out_class] = 2
+            gt_classes = _assign_labels(
+                matched_idxs, matched_labels, gt_classes, self.num_classes, filter_out_class
+            )
         else:
-            gt_classes = torch.zeros_like(matched_idxs) + self.num_classes
+            gt_classes = _const_full(
+                matched_idxs.numel(), self.num_classes, matched_idxs.dtype, matched_idxs.device
+            )
 
         sampled_fg_idxs, sampled_bg_idxs = subsample_labels(
             gt_classes, self.batch_size_per_image, self.positive_sample_fraction, self.num_classes
         )
 
         sampled_idxs = torch.cat([sampled_fg_idxs, sampled_bg_idxs], dim=0)
-        return sampled_idxs, gt_classes[sampled_idxs]
+        return (
+            sampled_idxs,
+            gt_classes[sampled_idxs],
+            sampled_fg_idxs.numel(),
+            sampled_bg_idxs.numel(),
+        )
 
     @torch.no_grad()
     def label_and_sample_proposals(
@@ -270,33 +525,55 @@ class ROIHeads(torch.nn.Module):
 
         num_fg_samples = []
         num_bg_samples = []
-        for proposals_per_image, targets_per_image in zip(proposals, targets):
+        proposals_to_gather = []
+        targets_to_gather = []
+        sampled_targets = []
+        match_quality_matrices = _pairwise_iou_per_image(
+            [x.gt_boxes for x in targets], [x.proposal_boxes for x in proposals]
+        )
+        # NOTE: the per-image work below is not dispatched on separate CUDA streams.
+        # Matcher (`torch.all` assert) and subsample_labels (`torch.nonzero`) both
+        # synchronize with the host, so kernels of different images could not overlap
+        # anyway. The IoU, the only sizeable kernel, is already batched above.
+        for proposals_per_image, targets_per_image, match_quality_matrix in zip(
+                proposals, targets, match_quality_matrices
+        ):
             has_gt = len(targets_per_image) > 0
-            match_quality_matrix = pairwise_iou(
-                targets_per_image.gt_boxes, proposals_per_image.proposal_boxes
-            )
-            matched_idxs, matched_labels = self.proposal_matcher(
-                match_quality_matrix)
-            sampled_idxs, gt_classes = self._sample_proposals(
-                matched_idxs, matched_labels, targets_per_image.gt_classes, filter_out_class=filter_out_class
-            )
+            if len(proposals_per_image) == 0:
+                # Nothing to match or sample from, skip the matcher and sampler.
+                matched_idxs = torch.empty(
+                    0, dtype=torch.int64, device=proposals_per_image.proposal_boxes.device
+                )
+                sampled_idxs = matched_idxs
+                gt_classes = targets_per_image.gt_classes[:0]
+                num_fg, num_bg = 0, 0
+            else:
+                if (
+                        match_quality_matrix.is_cuda
+                        and match_quality_matrix.numel() < _CPU_MATCHING_MAX_ELEMENTS
+                ):
+                    device = match_quality_matrix.device
+                    matched_idxs, matched_labels = self.proposal_matcher(
+                        match_quality_matrix.cpu())
+                    matched_idxs = matched_idxs.to(device)
+                    matched_labels = matched_labels.to(device)
+                else:
+                    matched_idxs, matched_labels = self.proposal_matcher(
+                        match_quality_matrix)
+                sampled_idxs, gt_classes, num_fg, num_bg = self._sample_proposals_with_counts(
+                    matched_idxs, matched_labels, targets_per_image.gt_classes,
+                    filter_out_class=filter_out_class
+                )
 
             # Set target attributes of the sampled proposals:
             proposals_per_image = proposals_per_image[sampled_idxs]
             proposals_per_image.gt_classes = gt_classes
 
-            # We index all the attributes of targets that start with "gt_"
-            # and have not been added to proposals yet (="gt_classes").
+            # The other "gt_" attributes are gathered for all images at once after the loop.
             if has_gt:
-                sampled_targets = matched_idxs[sampled_idxs]
-                # NOTE: here the indexing waste some compute, because heads
-                # like masks, keypoints, etc, will filter the proposals again,
-                # (by foreground/background, or number of keypoints in the image, etc)
-                # so we essentially index the data twice.
-                for (trg_name, trg_value) in targets_per_image.get_fields().items():
-                    if trg_name.startswith("gt_") and not proposals_per_image.has(trg_name):
-                        proposals_per_image.set(
-                            trg_name, trg_value[sampled_targets])
+                proposals_to_gather.append(proposals_per_image)
+                targets_to_gather.append(targets_per_image)
+                sampled_targets.append(matched_idxs[sampled_idxs])
             else:
                 gt_boxes = Boxes(
                     targets_per_image.gt_boxes.tensor.new_zeros(
@@ -304,12 +581,15 @@ class ROIHeads(torch.nn.Module):
                 )
                 proposals_per_image.gt_boxes = gt_boxes
 
-            num_bg_samples.append(
-                (gt_classes == self.num_classes).sum().item())
-            num_fg_samples.append(gt_classes.numel() - num_bg_samples[-1])
+            num_bg_samples.append(num_bg)
+            num_fg_samples.append(num_fg)
             proposals_with_gt.append(proposals_per_image)
 
-        # Log the number of fg/bg samples that are selected for training ROI heads
+        _gather_sampled_targets(proposals_to_gather, targets_to_gather, sampled_targets)
+
+        # Log the number of fg/bg samples that are selected for training ROI heads.
+        # Recorded on every iteration: the counts are already Python ints, and the writers'
+        # smoothed value then covers the iterations they report on.
         storage = get_event_storage()
         storage.put_scalar("roi_head/num_fg_samples", np.mean(num_fg_samples))
         storage.put_scalar("roi_head/num_bg_samples", np.mean(num_bg_samples))
@@ -369,7 +649,7 @@ class Res5ROIHeads(ROIHeads):
         # fmt: off
         pooler_resolution = cfg.MODEL.ROI_BOX_HEAD.POOLER_RESOLUTION
         pooler_type = cfg.MODEL.ROI_BOX_HEAD.POOLER_TYPE
-        pooler_scales = (1.0 / self.feature_strides[self.in_features[0]],)
+        pooler_scales = self.pooler_scales
         sampling_ratio = cfg.MODEL.ROI_BOX_HEAD.POOLER_SAMPLING_RATIO
         self.mask_on = cfg.MODEL.MASK_ON
         # fmt: on
@@ -436,13 +716,31 @@ class Res5ROIHeads(ROIHeads):
         del targets
 
         proposal_boxes = [x.proposal_boxes for x in proposals]
-        box_features = self._shared_roi_transform(
-            [features[f] for f in self.in_features], proposal_boxes
-        )
-        feature_pooled = box_features.mean(dim=[2, 3])  # pooled to 1x1
-        pred_class_logits, pred_proposal_deltas = self.box_predictor(
-            feature_pooled)
+        with self._autocast():
+            box_features = self._shared_roi_transform(
+                [features[f] for f in self.in_features], proposal_boxes
+            )
+            feature_pooled = box_features.mean(dim=[2, 3])  # pooled to 1x1
+            pred_class_logits, pred_proposal_deltas = self.box_predictor(
+                feature_pooled)
         del feature_pooled
+        # Box losses and inference are computed in float32
+        pred_class_logits = pred_class_logits.float()
+        pred_proposal_deltas = pred_proposal_deltas.float()
+
+        if self.training and self.mask_on:
+            fg_proposals, fg_selection_masks = select_foreground_proposals(
+                proposals, self.num_classes
+            )
+            # Since the ROI feature transform is shared between boxes and masks,
+            # we don't need to recompute features. The mask loss is only defined
+            # on foreground proposals, so we need to select out the foreground
+            # features.
+            fg_idxs = torch.nonzero(torch.cat(fg_selection_masks, dim=0)).squeeze(1)
+            mask_features = box_features.index_select(0, fg_idxs)
+        # The full (R, C, H, W) features of all proposals are not needed past this
+        # point; release them before the box losses / inference run.
+        del box_features
 
         outputs = FastRCNNOutputs(
             self.box2box_transform,
@@ -456,17 +754,8 @@ class Res5ROIHeads(ROIHeads):
             del features
             losses = outputs.losses()
             if self.mask_on:
-                proposals, fg_selection_masks = select_foreground_proposals(
-                    proposals, self.num_classes
-                )
-                # Since the ROI feature transform is shared between boxes and masks,
-                # we don't need to recompute features. The mask loss is only defined
-                # on foreground proposals, so we need to select out the foreground
-                # features.
-                mask_features = box_features[torch.cat(
-                    fg_selection_masks, dim=0)]
-                del box_features
-                losses.update(self.mask_head(mask_features, proposals))
+                with self._autocast():
+                    losses.update(self.mask_head(mask_features, fg_proposals))
             return [], losses
         else:
             pred_instances, _ = outputs.inference(
@@ -496,9 +785,10 @@ class Res5ROIHeads(ROIHeads):
 
         if self.mask_on:
             features = [features[f] for f in self.in_features]
-            x = self._shared_roi_transform(
-                features, [x.pred_boxes for x in instances])
-            return self.mask_head(x, instances)
+            with self._autocast():
+                x = self._shared_roi_transform(
+                    features, [x.pred_boxes for x in instances])
+                return self.mask_head(x, instances)
         else:
             return instances
 
@@ -521,6 +811,16 @@ class StandardROIHeads(ROIHeads):
         self._init_box_head(cfg)
         self._init_mask_head(cfg)
         self._init_keypoint_head(cfg)
+        # When the mask and keypoint heads pool identically, inference pools the predicted
+        # boxes only once. Subclasses that redefine the mask or keypoint branch keep the
+        # separate path.
+        self.share_mask_keypoint_features = (
+                self.mask_on
+                and self.keypoint_on
+                and type(self)._forward_mask is StandardROIHeads._forward_mask
+                and type(self)._forward_keypoint is StandardROIHeads._forward_keypoint
+                and self.keypoint_pooler is self.mask_pooler
+        )
         self.for_nuclei = False
         if hasattr(cfg.MODEL.ROI_HEADS, 'FOR_NUCLEI'):
             self.for_nuclei = True
@@ -528,7 +828,6 @@ class StandardROIHeads(ROIHeads):
     def _init_box_head(self, cfg):
         # fmt: off
         pooler_resolution = cfg.MODEL.ROI_BOX_HEAD.POOLER_RESOLUTION
-        pooler_scales = tuple(1.0 / self.feature_strides[k] for k in self.in_features)
         sampling_ratio = cfg.MODEL.ROI_BOX_HEAD.POOLER_SAMPLING_RATIO
         pooler_type = cfg.MODEL.ROI_BOX_HEAD.POOLER_TYPE
         self.train_on_pred_boxes = cfg.MODEL.ROI_BOX_HEAD.TRAIN_ON_PRED_BOXES
@@ -541,12 +840,7 @@ class StandardROIHeads(ROIHeads):
         assert len(set(in_channels)) == 1, in_channels
         in_channels = in_channels[0]
 
-        self.box_pooler = ROIPooler(
-            output_size=pooler_resolution,
-            scales=pooler_scales,
-            sampling_ratio=sampling_ratio,
-            pooler_type=pooler_type,
-        )
+        self.box_pooler = self._build_pooler(pooler_resolution, sampling_ratio, pooler_type)
         # Here we split "box head" and "box predictor", which is mainly due to historical reasons.
         # They are used together so the "box predictor" layers should be part of the "box head".
         # New subclasses of ROIHeads do not need "box predictor"s.
@@ -564,23 +858,19 @@ class StandardROIHeads(ROIHeads):
         if not self.mask_on:
             return
         pooler_resolution = cfg.MODEL.ROI_MASK_HEAD.POOLER_RESOLUTION
-        pooler_scales = tuple(1.0 / self.feature_strides[k] for k in self.in_features)
         sampling_ratio = cfg.MODEL.ROI_MASK_HEAD.POOLER_SAMPLING_RATIO
         pooler_type = cfg.MODEL.ROI_MASK_HEAD.POOLER_TYPE
         # fmt: on
 
         in_channels = [self.feature_channels[f] for f in self.in_features][0]
 
-        self.mask_pooler = ROIPooler(
-            output_size=pooler_resolution,
-            scales=pooler_scales,
-            sampling_ratio=sampling_ratio,
-            pooler_type=pooler_type,
-        )
+        self.mask_pooler = self._build_pooler(pooler_resolution, sampling_ratio, pooler_type)
         self.mask_head = build_mask_head(
             cfg, ShapeSpec(channels=in_channels,
                            width=pooler_resolution, height=pooler_resolution)
         )
+        if self.channels_last:
+            self.mask_head.to(memory_format=torch.channels_last)
 
     def _init_keypoint_head(self, cfg):
         # fmt: off
@@ -588,25 +878,23 @@ class StandardROIHeads(ROIHeads):
         if not self.keypoint_on:
             return
         pooler_resolution = cfg.MODEL.ROI_KEYPOINT_HEAD.POOLER_RESOLUTION
-        pooler_scales = tuple(1.0 / self.feature_strides[k] for k in self.in_features)  # noqa
         sampling_ratio = cfg.MODEL.ROI_KEYPOINT_HEAD.POOLER_SAMPLING_RATIO
         pooler_type = cfg.MODEL.ROI_KEYPOINT_HEAD.POOLER_TYPE
         self.normalize_loss_by_visible_keypoints = cfg.MODEL.ROI_KEYPOINT_HEAD.NORMALIZE_LOSS_BY_VISIBLE_KEYPOINTS  # noqa
         self.keypoint_loss_weight = cfg.MODEL.ROI_KEYPOINT_HEAD.LOSS_WEIGHT
         # fmt: on
+        # Expected number of positive proposals per image, used by the keypoint loss normalizer
+        self.num_expected_fg_per_image = self.batch_size_per_image * self.positive_sample_fraction
 
         in_channels = [self.feature_channels[f] for f in self.in_features][0]
 
-        self.keypoint_pooler = ROIPooler(
-            output_size=pooler_resolution,
-            scales=pooler_scales,
-            sampling_ratio=sampling_ratio,
-            pooler_type=pooler_type,
-        )
+        self.keypoint_pooler = self._build_pooler(pooler_resolution, sampling_ratio, pooler_type)
         self.keypoint_head = build_keypoint_head(
             cfg, ShapeSpec(channels=in_channels,
                            width=pooler_resolution, height=pooler_resolution)
         )
+        if self.channels_last:
+            self.keypoint_head.to(memory_format=torch.channels_last)
 
     def forward(
             self,
@@ -638,6 +926,10 @@ class StandardROIHeads(ROIHeads):
             losses.update(self._forward_keypoint(features_list, proposals))
             return proposals, losses
         else:
+            # NOTE: inference is not captured as a CUDA graph. ROIPooler assigns boxes to
+            # levels with `torch.nonzero`, and score thresholding and NMS produce a
+            # data-dependent number of detections, so neither the box branch nor the
+            # mask/keypoint heads run with static shapes or without host synchronization.
             pred_instances = self._forward_box(features_list, proposals)
             # During inference cascaded prediction is used: the mask and keypoints heads are only
             # applied to the top scoring box detections.
@@ -669,8 +961,18 @@ class StandardROIHeads(ROIHeads):
         assert instances[0].has(
             "pred_boxes") and instances[0].has("pred_classes")
         features_list = [features[f] for f in self.in_features]
-        instances = self._forward_mask(features_list, instances)
-        instances = self._forward_keypoint(features_list, instances)
+        # The mask and keypoint heads pool from the same boxes
+        pred_boxes = [x.pred_boxes for x in instances]
+        if self.share_mask_keypoint_features:
+            with self._autocast():
+                roi_features = self._to_head_memory_format(
+                    self.mask_pooler(features_list, pred_boxes))
+                instances = self.mask_head(roi_features, instances)
+                keypoint_logits = self.keypoint_head(roi_features)
+            keypoint_rcnn_inference(keypoint_logits.float(), instances)
+            return instances
+        instances = self._forward_mask(features_list, instances, pred_boxes)
+        instances = self._forward_keypoint(features_list, instances, pred_boxes)
         return instances
 
     def _forward_box(
@@ -691,12 +993,16 @@ class StandardROIHeads(ROIHeads):
             In training, a dict of losses.
             In inference, a list of `Instances`, the predicted instances.
         """
-        box_features = self.box_pooler(
-            features, [x.proposal_boxes for x in proposals])
-        box_features = self.box_head(box_features)
-        pred_class_logits, pred_proposal_deltas = self.box_predictor(
-            box_features)
+        with self._autocast():
+            box_features = self.box_pooler(
+                features, [x.proposal_boxes for x in proposals])
+            box_features = self.box_head(box_features)
+            pred_class_logits, pred_proposal_deltas = self.box_predictor(
+                box_features)
         del box_features
+        # Box losses and inference are computed in float32
+        pred_class_logits = pred_class_logits.float()
+        pred_proposal_deltas = pred_proposal_deltas.float()
 
         outputs = FastRCNNOutputs(
             self.box2box_transform,
@@ -720,7 +1026,10 @@ class StandardROIHeads(ROIHeads):
             return pred_instances
 
     def _forward_mask(
-            self, features: List[torch.Tensor], instances: List[Instances]
+            self,
+            features: List[torch.Tensor],
+            instances: List[Instances],
+            pred_boxes: Optional[List[Boxes]] = None,
     ) -> Union[Dict[str, torch.Tensor], List[Instances]]:
         """
         Forward logic of the mask prediction branch.
@@ -730,6 +1039,8 @@ class StandardROIHeads(ROIHeads):
             instances (list[Instances]): the per-image instances to train/predict masks.
                 In training, they can be the proposals.
                 In inference, they can be the predicted boxes.
+            pred_boxes (list[Boxes], optional): in inference, the "pred_boxes" of `instances`,
+                if already collected by the caller.
 
         Returns:
             In training, a dict of losses.
@@ -743,15 +1054,23 @@ class StandardROIHeads(ROIHeads):
             proposals, _ = select_foreground_proposals(
                 instances, self.num_classes)
             proposal_boxes = [x.proposal_boxes for x in proposals]
-            mask_features = self.mask_pooler(features, proposal_boxes)
-            return self.mask_head(mask_features, proposals)
+            with self._autocast():
+                mask_features = self._to_head_memory_format(
+                    self.mask_pooler(features, proposal_boxes))
+                return self.mask_head(mask_features, proposals)
         else:
-            pred_boxes = [x.pred_boxes for x in instances]
-            mask_features = self.mask_pooler(features, pred_boxes)
-            return self.mask_head(mask_features, instances)
+            if pred_boxes is None:
+                pred_boxes = [x.pred_boxes for x in instances]
+            with self._autocast():
+                mask_features = self._to_head_memory_format(
+                    self.mask_pooler(features, pred_boxes))
+                return self.mask_head(mask_features, instances)
 
     def _forward_keypoint(
-            self, features: List[torch.Tensor], instances: List[Instances]
+            self,
+            features: List[torch.Tensor],
+            instances: List[Instances],
+            pred_boxes: Optional[List[Boxes]] = None,
     ) -> Union[Dict[str, torch.Tensor], List[Instances]]:
         """
         Forward logic of the keypoint prediction branch.
@@ -761,6 +1080,8 @@ class StandardROIHeads(ROIHeads):
             instances (list[Instances]): the per-image instances to train/predict keypoints.
                 In training, they can be the proposals.
                 In inference, they can be the predicted boxes.
+            pred_boxes (list[Boxes], optional): in inference, the "pred_boxes" of `instances`,
+                if already collected by the caller.
 
         Returns:
             In training, a dict of losses.
@@ -778,15 +1099,13 @@ class StandardROIHeads(ROIHeads):
             proposals = select_proposals_with_visible_keypoints(proposals)
             proposal_boxes = [x.proposal_boxes for x in proposals]
 
-            keypoint_features = self.keypoint_pooler(features, proposal_boxes)
-            keypoint_logits = self.keypoint_head(keypoint_features)
+            with self._autocast():
+                keypoint_features = self._to_head_memory_format(
+                    self.keypoint_pooler(features, proposal_boxes))
+                keypoint_logits = self.keypoint_head(keypoint_features)
+            keypoint_logits = keypoint_logits.float()
 
-            normalizer = (
-                    num_images
-                    * self.batch_size_per_image
-                    * self.positive_sample_fraction
-                    * keypoint_logits.shape[1]
-            )
+            normalizer = num_images * self.num_expected_fg_per_image * keypoint_logits.shape[1]
             loss = keypoint_rcnn_loss(
                 keypoint_logits,
                 proposals,
@@ -794,10 +1113,13 @@ class StandardROIHeads(ROIHeads):
             )
             return {"loss_keypoint": loss * self.keypoint_loss_weight}
         else:
-            pred_boxes = [x.pred_boxes for x in instances]
-            keypoint_features = self.keypoint_pooler(features, pred_boxes)
-            keypoint_logits = self.keypoint_head(keypoint_features)
-            keypoint_rcnn_inference(keypoint_logits, instances)
+            if pred_boxes is None:
+                pred_boxes = [x.pred_boxes for x in instances]
+            with self._autocast():
+                keypoint_features = self._to_head_memory_format(
+                    self.keypoint_pooler(features, pred_boxes))
+                keypoint_logits = self.keypoint_head(keypoint_features)
+            keypoint_rcnn_inference(keypoint_logits.float(), instances)
             return instances
 
 
@@ -1415,6 +1737,8 @@ and the occlusion mask (occlusion mask head).
         self.rpn_attention_tb = False
         if hasattr(cfg.MODEL, 'RPN_ATTENTION'):
             self.rpn_attention_tb = cfg.MODEL.RPN_ATTENTION
+        # Debug-only: turned on with DETECTRON2_CHECK_FINITE=1
+        self.check_finite_features = os.environ.get("DETECTRON2_CHECK_FINITE", "0") == "1"
 
         self.branch_guidance = False
         if hasattr(cfg.MODEL.ROI_TRIPLE_BRANCH_WHOLE_MASK_HEAD, 'BRANCH_GUIDANCE'):
@@ -1455,11 +1779,13 @@ and the occlusion mask (occlusion mask head).
             for i, layer in enumerate(self.branch_guidance_conv_non_overlap):
                 self.add_module(
                     "branch_guidance_conv_non_overlap_layer{}".format(i), layer)
+            if self.channels_last:
+                for layer in self.branch_guidance_conv_overlap + self.branch_guidance_conv_non_overlap:
+                    layer.to(memory_format=torch.channels_last)
 
     def _init_box_head(self, cfg):
         # fmt: off
         pooler_resolution = cfg.MODEL.ROI_BOX_HEAD.POOLER_RESOLUTION
-        pooler_scales = tuple(1.0 / self.feature_strides[k] for k in self.in_features)
         sampling_ratio = cfg.MODEL.ROI_BOX_HEAD.POOLER_SAMPLING_RATIO
         pooler_type = cfg.MODEL.ROI_BOX_HEAD.POOLER_TYPE
         self.train_on_pred_boxes = cfg.MODEL.ROI_BOX_HEAD.TRAIN_ON_PRED_BOXES
@@ -1472,12 +1798,7 @@ and the occlusion mask (occlusion mask head).
         assert len(set(in_channels)) == 1, in_channels
         in_channels = in_channels[0]
 
-        self.box_pooler = ROIPooler(
-            output_size=pooler_resolution,
-            scales=pooler_scales,
-            sampling_ratio=sampling_ratio,
-            pooler_type=pooler_type,
-        )
+        self.box_pooler = self._build_pooler(pooler_resolution, sampling_ratio, pooler_type)
         # Here we split "box head" and "box predictor", which is mainly due to historical reasons.
         # They are used together so the "box predictor" layers should be part of the "box head".
         # New subclasses of ROIHeads do not need "box predictor"s.
@@ -1496,21 +1817,17 @@ and the occlusion mask (occlusion mask head).
             return
 
         pooler_resolution = cfg.MODEL.ROI_TRIPLE_BRANCH_WHOLE_MASK_HEAD.POOLER_RESOLUTION
-        pooler_scales = tuple(1.0 / self.feature_strides[k] for k in self.in_features)
         sampling_ratio = cfg.MODEL.ROI_TRIPLE_BRANCH_WHOLE_MASK_HEAD.POOLER_SAMPLING_RATIO
         pooler_type = cfg.MODEL.ROI_TRIPLE_BRANCH_WHOLE_MASK_HEAD.POOLER_TYPE
         # fmt: on
         in_channels = [self.feature_channels[f] for f in self.in_features][0]
-        self.mask_pooler = ROIPooler(
-            output_size=pooler_resolution,
-            scales=pooler_scales,
-            sampling_ratio=sampling_ratio,
-            pooler_type=pooler_type,
-        )
+        self.mask_pooler = self._build_pooler(pooler_resolution, sampling_ratio, pooler_type)
         self.triple_branch_whole_mask_head = build_triple_branch_whole_mask_head(
             cfg, ShapeSpec(channels=in_channels,
                            width=pooler_resolution, height=pooler_resolution)
         )
+        if self.channels_last:
+            self.triple_branch_whole_mask_head.to(memory_format=torch.channels_last)
 
     def _init_triple_branch_overlapping_mask_head(self, cfg):
         # fmt: off
@@ -1524,6 +1841,8 @@ and the occlusion mask (occlusion mask head).
             cfg, ShapeSpec(channels=in_channels,
                            width=pooler_resolution, height=pooler_resolution)
         )
+        if self.channels_last:
+            self.triple_branch_overlapping_mask_head.to(memory_format=torch.channels_last)
 
     def _init_triple_branch_nonoverlapping_mask_head(self, cfg):
         # fmt: off
@@ -1537,6 +1856,8 @@ and the occlusion mask (occlusion mask head).
             cfg, ShapeSpec(channels=in_channels,
                            width=pooler_resolution, height=pooler_resolution)
         )
+        if self.channels_last:
+            self.triple_branch_nonoverlapping_mask_head.to(memory_format=torch.channels_last)
 
     def _forward_triple_branch_whole_mask(self, features: List[torch.Tensor], instances: List[Instances],
                                           guiding_layers=True):
@@ -1555,9 +1876,7 @@ and the occlusion mask (occlusion mask head).
         """
         if not self.mask_on:
             return {} if self.training else instances
-        if self.training:
-            return self.triple_branch_whole_mask_head(features, instances, guiding_layers)
-        else:
+        with self._autocast():
             return self.triple_branch_whole_mask_head(features, instances, guiding_layers)
 
     def _forward_triple_branch_overlapping_mask(self, features: List[torch.Tensor], instances: List[Instances]):
@@ -1576,9 +1895,7 @@ and the occlusion mask (occlusion mask head).
         """
         if not self.mask_on:
             return {} if self.training else instances
-        if self.training:
-            return self.triple_branch_overlapping_mask_head(features, instances)
-        else:
+        with self._autocast():
             return self.triple_branch_overlapping_mask_head(features, instances)
 
     def _forward_triple_branch_nonoverlapping_mask(self, features: List[torch.Tensor], instances: List[Instances]):
@@ -1597,9 +1914,7 @@ and the occlusion mask (occlusion mask head).
         """
         if not self.mask_on:
             return {} if self.training else instances
-        if self.training:
-            return self.triple_branch_nonoverlapping_mask_head(features, instances)
-        else:
+        with self._autocast():
             return self.triple_branch_nonoverlapping_mask_head(features, instances)
 
     def _forward_box(
@@ -1676,20 +1991,29 @@ and the occlusion mask (occlusion mask head).
         # TODO TODO TODO
         features_list = [features[f] for f in self.in_features]
         pred_boxes = [x.pred_boxes for x in instances]
-        mask_features = self.mask_pooler(features_list, pred_boxes)
+        with self._autocast():
+            mask_features = self._to_head_memory_format(
+                self.mask_pooler(features_list, pred_boxes))
 
+        # Outputs of the whole mask head on `mask_features` with guiding_layers=False, if computed
+        whole_mask_outputs = None
         if self.branch_guidance:
-            instances, _, triple_branch_whole_mask_inner_feature_for_branch_guidance = self._forward_triple_branch_whole_mask(
+            whole_mask_outputs = self._forward_triple_branch_whole_mask(
                 mask_features, instances, guiding_layers=False)
+            instances, _, triple_branch_whole_mask_inner_feature_for_branch_guidance = whole_mask_outputs
             mask_features_for_over_nonover_branches = torch.cat(
-                [mask_features] + [triple_branch_whole_mask_inner_feature_for_branch_guidance], 1)
-            for layer in self.branch_guidance_conv_overlap:
-                mask_features_for_over_branches = layer(mask_features_for_over_nonover_branches)
-            for layer in self.branch_guidance_conv_non_overlap:
-                mask_features_for_nonover_branches = layer(mask_features_for_over_nonover_branches)
+                [mask_features, triple_branch_whole_mask_inner_feature_for_branch_guidance], 1)
+            # Each guidance layer is applied to the same input and only the last output is kept,
+            # so only the last layer of each stack needs to run.
+            with self._autocast():
+                mask_features_for_over_branches = self.branch_guidance_conv_overlap[-1](
+                    mask_features_for_over_nonover_branches)
+                mask_features_for_nonover_branches = self.branch_guidance_conv_non_overlap[-1](
+                    mask_features_for_over_nonover_branches)
         elif self.heads_attention:
-            _, _, triple_branch_whole_mask_attention = self._forward_triple_branch_whole_mask(mask_features, instances,
-                                                                                              guiding_layers=False)
+            whole_mask_outputs = self._forward_triple_branch_whole_mask(
+                mask_features, instances, guiding_layers=False)
+            _, _, triple_branch_whole_mask_attention = whole_mask_outputs
             mask_features_for_over_nonover_branches = mask_features * triple_branch_whole_mask_attention
         else:
             mask_features_for_over_nonover_branches = mask_features
@@ -1709,12 +2033,18 @@ and the occlusion mask (occlusion mask head).
 
         if self.refinement:
             if self.pure_branch:
-                instances, whole_mask_logits, triple_branch_whole_mask_inner_feature = self._forward_triple_branch_whole_mask(
-                    mask_features, instances, guiding_layers=False)
+                # Same call as the guidance / attention pass above: reuse its outputs if computed
+                if whole_mask_outputs is None:
+                    whole_mask_outputs = self._forward_triple_branch_whole_mask(
+                        mask_features, instances, guiding_layers=False)
+                instances, whole_mask_logits, triple_branch_whole_mask_inner_feature = whole_mask_outputs
             else:
                 concatenated_mask_feature = torch.cat(
-                    [mask_features] + [triple_branch_overlapping_mask_inner_feature] + [
-                        triple_branch_nonoverlapping_mask_inner_feature], 1)
+                    [mask_features, triple_branch_overlapping_mask_inner_feature,
+                     triple_branch_nonoverlapping_mask_inner_feature], 1)
+                # The inner features now live in the concatenation; release the sources so
+                # they do not stay allocated while the whole mask head runs.
+                del triple_branch_overlapping_mask_inner_feature, triple_branch_nonoverlapping_mask_inner_feature
 
                 instances, whole_mask_logits, triple_branch_whole_mask_inner_feature = self._forward_triple_branch_whole_mask(
                     concatenated_mask_feature, instances)
@@ -1769,10 +2099,10 @@ and the occlusion mask (occlusion mask head).
 
         features_list = [features[f] for f in self.in_features]
 
-        features_valid = [torch.isfinite(features[f]).all() for f in self.in_features]
-
-        if features_valid.count(False) != 0:
-            print("Non finite features appears!")
+        if self.check_finite_features:
+            # A full pass over every feature map: reduce all levels on device, sync once
+            if not torch.stack([torch.isfinite(x).all() for x in features_list]).all():
+                print("Non finite features appears!")
 
         if self.training:
             if self.unlabeled:
@@ -1790,27 +2120,40 @@ and the occlusion mask (occlusion mask head).
                 selected_proposals, _ = select_foreground_proposals(
                     proposals, self.num_classes)
             proposal_boxes = [x.proposal_boxes for x in selected_proposals]
-            mask_features = self.mask_pooler(features_list, proposal_boxes)
+            with self._autocast():
+                mask_features = self._to_head_memory_format(
+                    self.mask_pooler(features_list, proposal_boxes))
 
             # Head TODO:
             # TODO: modify so that it can give the inner feature
 
+            # Outputs of the whole mask head on `mask_features` with guiding_layers=False, if computed
+            whole_mask_outputs = None
+            # Unlabeled batches drop the branch losses, and the pure-branch refinement reuses the whole-mask
+            # outputs: the overlapping / non-overlapping heads are then only needed by the consistency loss.
+            run_branch_heads = not (self.unlabeled and self.refinement and self.pure_branch and not self.consis_loss)
             if self.branch_guidance:
-                triple_branch_whole_attention_mask_loss, triple_branch_whole_attention_mask_logits, triple_branch_whole_mask_inner_feature_for_branch_guidance = self._forward_triple_branch_whole_mask(
+                whole_mask_outputs = self._forward_triple_branch_whole_mask(
                     mask_features, selected_proposals, guiding_layers=False)
+                triple_branch_whole_attention_mask_loss, triple_branch_whole_attention_mask_logits, triple_branch_whole_mask_inner_feature_for_branch_guidance = whole_mask_outputs
                 if not self.unlabeled:
                     triple_branch_whole_attention_mask_loss = {key: value * 0.75 for key, value in
                                                                triple_branch_whole_attention_mask_loss.items()}
                     losses.update(triple_branch_whole_attention_mask_loss)
-                mask_features_for_over_nonover_branches = torch.cat(
-                    [mask_features] + [triple_branch_whole_mask_inner_feature_for_branch_guidance], 1)
-                for layer in self.branch_guidance_conv_overlap:
-                    mask_features_for_over_branches = layer(mask_features_for_over_nonover_branches)
-                for layer in self.branch_guidance_conv_non_overlap:
-                    mask_features_for_nonover_branches = layer(mask_features_for_over_nonover_branches)
+                if run_branch_heads:
+                    mask_features_for_over_nonover_branches = torch.cat(
+                        [mask_features, triple_branch_whole_mask_inner_feature_for_branch_guidance], 1)
+                    # Each guidance layer is applied to the same input and only the last output is kept,
+                    # so only the last layer of each stack needs to run.
+                    with self._autocast():
+                        mask_features_for_over_branches = self.branch_guidance_conv_overlap[-1](
+                            mask_features_for_over_nonover_branches)
+                        mask_features_for_nonover_branches = self.branch_guidance_conv_non_overlap[-1](
+                            mask_features_for_over_nonover_branches)
             elif self.heads_attention:
-                triple_branch_whole_attention_mask_loss, _, triple_branch_whole_mask_attention = self._forward_triple_branch_whole_mask(
+                whole_mask_outputs = self._forward_triple_branch_whole_mask(
                     mask_features, selected_proposals, guiding_layers=False)
+                triple_branch_whole_attention_mask_loss, _, triple_branch_whole_mask_attention = whole_mask_outputs
                 # triple_branch_whole_attention_mask_loss = {key:value*0.5 for key, value in triple_branch_whole_attention_mask_loss.items()}
                 if self.unlabeled:
                     del triple_branch_whole_attention_mask_loss
@@ -1821,49 +2164,52 @@ and the occlusion mask (occlusion mask head).
             else:
                 mask_features_for_over_nonover_branches = mask_features
 
-            if self.branch_guidance:
-                # TODO: make overlapping branch from visible branch, remember to change data input
-                triple_branch_overlapping_mask_loss, triple_branch_overlapping_mask_logits, triple_branch_overlapping_mask_inner_feature = self._forward_triple_branch_overlapping_mask(
-                    mask_features_for_over_branches, selected_proposals)
-                if self.unlabeled:
-                    del triple_branch_overlapping_mask_loss
-                else:
-                    losses.update(triple_branch_overlapping_mask_loss)
-
-                # TODO: make nonoverlapping branch from visible branch, remember to change data input
-                triple_branch_nonoverlapping_mask_loss, triple_branch_nonoverlapping_mask_logits, triple_branch_nonoverlapping_mask_inner_feature = self._forward_triple_branch_nonoverlapping_mask(
-                    mask_features_for_nonover_branches, selected_proposals)
-                if self.unlabeled:
-                    del triple_branch_nonoverlapping_mask_loss
-                else:
-                    losses.update(triple_branch_nonoverlapping_mask_loss)
-            else:
-                # TODO: make overlapping branch from visible branch, remember to change data input
-                triple_branch_overlapping_mask_loss, triple_branch_overlapping_mask_logits, triple_branch_overlapping_mask_inner_feature = self._forward_triple_branch_overlapping_mask(
-                    mask_features_for_over_nonover_branches, selected_proposals)
-                if self.unlabeled:
-                    del triple_branch_overlapping_mask_loss
-                else:
-                    losses.update(triple_branch_overlapping_mask_loss)
-
-                # TODO: make nonoverlapping branch from visible branch, remember to change data input
-                triple_branch_nonoverlapping_mask_loss, triple_branch_nonoverlapping_mask_logits, triple_branch_nonoverlapping_mask_inner_feature = self._forward_triple_branch_nonoverlapping_mask(
-                    mask_features_for_over_nonover_branches, selected_proposals)
-                if self.unlabeled:
-                    del triple_branch_nonoverlapping_mask_loss
+            if run_branch_heads:
+                if self.branch_guidance:
+                    # TODO: make overlapping branch from visible branch, remember to change data input
+                    triple_branch_overlapping_mask_loss, triple_branch_overlapping_mask_logits, triple_branch_overlapping_mask_inner_feature = self._forward_triple_branch_overlapping_mask(
+                        mask_features_for_over_branches, selected_proposals)
+                    if self.unlabeled:
+                        del triple_branch_overlapping_mask_loss
+                    else:
+                        losses.update(triple_branch_overlapping_mask_loss)
+
+                    # TODO: make nonoverlapping branch from visible branch, remember to change data input
+                    triple_branch_nonoverlapping_mask_loss, triple_branch_nonoverlapping_mask_logits, triple_branch_nonoverlapping_mask_inner_feature = self._forward_triple_branch_nonoverlapping_mask(
+                        mask_features_for_nonover_branches, selected_proposals)
+                    if self.unlabeled:
+                        del triple_branch_nonoverlapping_mask_loss
+                    else:
+                        losses.update(triple_branch_nonoverlapping_mask_loss)
                 else:
-                    losses.update(triple_branch_nonoverlapping_mask_loss)
+                    # TODO: make overlapping branch from visible branch, remember to change data input
+                    triple_branch_overlapping_mask_loss, triple_branch_overlapping_mask_logits, triple_branch_overlapping_mask_inner_feature = self._forward_triple_branch_overlapping_mask(
+                        mask_features_for_over_nonover_branches, selected_proposals)
+                    if self.unlabeled:
+                        del triple_branch_overlapping_mask_loss
+                    else:
+                        losses.update(triple_branch_overlapping_mask_loss)
+
+                    # TODO: make nonoverlapping branch from visible branch, remember to change data input
+                    triple_branch_nonoverlapping_mask_loss, triple_branch_nonoverlapping_mask_logits, triple_branch_nonoverlapping_mask_inner_feature = self._forward_triple_branch_nonoverlapping_mask(
+                        mask_features_for_over_nonover_branches, selected_proposals)
+                    if self.unlabeled:
+                        del triple_branch_nonoverlapping_mask_loss
+                    else:
+                        losses.update(triple_branch_nonoverlapping_mask_loss)
 
             if self.refinement:
                 if self.pure_branch:
-                    triple_branch_whole_mask_loss, triple_branch_whole_mask_logits, triple_branch_whole_mask_inner_feature = self._forward_triple_branch_whole_mask(
-                        mask_features, selected_proposals, guiding_layers=False)
-                    losses.update(triple_branch_whole_mask_loss)
+                    # Same call as the guidance / attention pass above: reuse its outputs if computed
+                    if whole_mask_outputs is None:
+                        whole_mask_outputs = self._forward_triple_branch_whole_mask(
+                            mask_features, selected_proposals, guiding_layers=False)
+                    triple_branch_whole_mask_loss, triple_branch_whole_mask_logits, triple_branch_whole_mask_inner_feature = whole_mask_outputs
                 else:
                     # TODO: concate √
                     concatenated_mask_feature = torch.cat(
-                        [mask_features] + [triple_branch_overlapping_mask_inner_feature] + [
-                            triple_branch_nonoverlapping_mask_inner_feature], 1)
+                        [mask_features, triple_branch_overlapping_mask_inner_feature,
+                         triple_branch_nonoverlapping_mask_inner_feature], 1)
                     # TODO: make Conv layers in whole branch
                     triple_branch_whole_mask_loss, triple_branch_whole_mask_logits, triple_branch_whole_mask_inner_feature = self._forward_triple_branch_whole_mask(
                         concatenated_mask_feature, selected_proposals)
@@ -1873,16 +2219,19 @@ and the occlusion mask (occlusion mask head).
                     losses.update(triple_branch_whole_mask_loss)
 
             if self.branch_guidance and self.unlabeled:
-                losses.update({"branch_guidance_consistency_loss": 0.1 * F.binary_cross_entropy(
-                    input=(triple_branch_whole_attention_mask_logits.sigmoid()).sigmoid(),
-                    target=(triple_branch_whole_mask_logits.sigmoid()).sigmoid(), reduction="mean")})
+                # BCE(sigmoid(z), t) is BCE-with-logits(z, t): feeding sigmoid(logits) as z keeps the
+                # same loss with one sigmoid less, in the fused and numerically stable kernel.
+                losses.update({"branch_guidance_consistency_loss": 0.1 * F.binary_cross_entropy_with_logits(
+                    input=triple_branch_whole_attention_mask_logits.float().sigmoid(),
+                    target=(triple_branch_whole_mask_logits.float().sigmoid()).sigmoid(), reduction="mean")})
 
             if self.consis_loss:
                 if self.consis_loss_mode == "MX":  # mask xor
-                    triple_branch_main_mask_loss_input = (triple_branch_whole_mask_logits.sigmoid() > 0.5).float()
+                    # sigmoid(x) > 0.5 is x > 0: threshold the logits directly
+                    triple_branch_main_mask_loss_input = (triple_branch_whole_mask_logits > 0).float()
                     triple_branch_addition_mask_loss_input = (
-                                triple_branch_nonoverlapping_mask_logits.sigmoid() > 0.5).logical_xor(
-                        triple_branch_overlapping_mask_logits.sigmoid() > 0.5).float()
+                                triple_branch_nonoverlapping_mask_logits > 0).logical_xor(
+                        triple_branch_overlapping_mask_logits > 0).float()
                     triple_branch_consistency_loss = {
                         "loss_triple_branch_consistency": self.cal_triple_branch_consistency_loss(
                             triple_branch_main_mask_loss_input, triple_branch_addition_mask_loss_input,
@@ -1890,7 +2239,7 @@ and the occlusion mask (occlusion mask head).
 
                 losses.update(triple_branch_consistency_loss)
             if self.rpn_attention_tb:
-                return proposals, losses, triple_branch_whole_mask_logits, selected_proposals
+                return proposals, losses, triple_branch_whole_mask_logits.float(), selected_proposals
             return proposals, losses
         else:
             pred_instances = self._forward_box(features_list, proposals)
@@ -1899,53 +2248,8 @@ and the occlusion mask (occlusion mask head).
             if self.rpn_attention_tb:
                 pred_instances, triple_branch_whole_mask_logits = self.forward_with_given_boxes(
                     features, pred_instances)
-                return pred_instances, {}, triple_branch_whole_mask_logits
+                return pred_instances, {}, triple_branch_whole_mask_logits.float()
 
             pred_instances = self.forward_with_given_boxes(
                 features, pred_instances)
             return pred_instances, {}
-
-
-def get_pred_masks_logits_by_cls(pred_mask_logits, instances):
-    cls_agnostic_mask = pred_mask_logits.size(1) == 1
-    total_num_masks = pred_mask_logits.size(0)
-
-    if isinstance(instances, list):
-        mask_side_len = pred_mask_logits.size(2)
-        assert pred_mask_logits.size(2) == pred_mask_logits.size(3), "Mask prediction must be square!"
-
-        gt_classes = []
-        gt_masks = []
-        for instances_per_image in instances:
-            if len(instances_per_image) == 0:
-                continue
-            if not cls_agnostic_mask:
-                gt_classes_per_image = instances_per_image.gt_classes.to(dtype=torch.int64)
-                gt_classes.append(gt_classes_per_image)
-            gt_masks_per_image = instances_per_image.gt_masks.crop_and_resize(
-                instances_per_image.proposal_boxes.tensor, mask_side_len
-            ).to(device=pred_mask_logits.device)
-            # num_regions*28*28
-            # A tensor of shape (N, M, M), N=#instances in the image; M=mask_side_len
-            gt_masks.append(gt_masks_per_image)
-        if len(gt_masks) == 0:
-            return pred_mask_logits.sum() * 0
-        gt_masks = cat(gt_masks, dim=0)
-
-        if cls_agnostic_mask:
-            pred_mask_logits = pred_mask_logits[:, 0]
-        else:
-            indices = torch.arange(total_num_masks)
-            gt_classes = cat(gt_classes, dim=0)
-            pred_mask_logits = pred_mask_logits[indices, gt_classes]
-
-        gt_masks = gt_masks.float()
-
-        return pred_mask_logits.unsqueeze(1), gt_masks.unsqueeze(1)
-    else:
-        indices = torch.arange(total_num_masks)
-        gt_classes = instances
-
-        pred_mask_logits = pred_mask_logits[indices, gt_classes]
-
-        return pred_mask_logits.unsqueeze(1)
@@ -322,10 +322,14 @@ def pairwise_iou(boxes1: Boxes, boxes2: Boxes) -> torch.Tensor:
     inter = width_height.prod(dim=2)  # [N,M]
     del width_height
 
+    # Computed in the dtype of the boxes (float32): areas of boxes larger than
+    # ~256x256 pixels overflow float16.
+    union = area1[:, None] + area2  # [N,M]
+    union -= inter
     # handle empty boxes
     iou = torch.where(
         inter > 0,
-        inter / (area1[:, None] + area2 - inter),
+        inter / union,
         torch.zeros(1, dtype=inter.dtype, device=inter.device),
     )
     return iou
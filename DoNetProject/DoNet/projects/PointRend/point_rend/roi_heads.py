@@ -98,7 +98,7 @@ class PointRendROIHeads(StandardROIHeads):
             cfg, ShapeSpec(channels=in_channels, width=1, height=1)
         )
 
-    def _forward_mask(self, features, instances):
+    def _forward_mask(self, features, instances, pred_boxes=None):
         """
         Forward logic of the mask prediction branch.
 
@@ -107,6 +107,8 @@ class PointRendROIHeads(StandardROIHeads):
             instances (list[Instances]): the per-image instances to train/predict masks.
                 In training, they can be the proposals.
                 In inference, they can be the predicted boxes.
+            pred_boxes (list[Boxes], optional): in inference, the "pred_boxes" of `instances`,
+                if already collected by the caller.
 
         Returns:
             In training, a dict of losses.
@@ -124,7 +126,8 @@ class PointRendROIHeads(StandardROIHeads):
             losses.update(self._forward_mask_point(features, mask_coarse_logits, proposals))
             return losses
         else:
-            pred_boxes = [x.pred_boxes for x in instances]
+            if pred_boxes is None:
+                pred_boxes = [x.pred_boxes for x in instances]
             mask_coarse_logits = self._forward_mask_coarse(features, pred_boxes)
 
             mask_logits = self._forward_mask_point(features, mask_coarse_logits, instances)